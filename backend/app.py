@@ -1,13 +1,24 @@
 from flask import Flask, request, jsonify, make_response
 from flask_cors import CORS
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
 from datetime import datetime, timedelta
 import os
-from sqlalchemy import or_
+import re
+import time
+from sqlalchemy import or_, event, inspect, select, insert, update, delete
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql.util import find_tables
 import bcrypt
+import click
 import secrets
+import threading
 import jwt
+from contextlib import contextmanager
+from contextvars import ContextVar
 from functools import wraps
+from itertools import chain
+from sharding import ConsistentHashRing
 
 app = Flask(__name__)
 
@@ -24,11 +35,68 @@ CORS(app,
      allow_headers=["Content-Type", "Authorization", "x-access-token"])
 
 # Database configuration
-basedir = os.path.abspath(os.path.dirname(__file__))
+# Database files live next to app.py unless APPOINTMENTS_DATA_DIR is set
+basedir = os.environ.get('APPOINTMENTS_DATA_DIR', os.path.abspath(os.path.dirname(__file__)))
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, 'appointments.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
-db = SQLAlchemy(app)
+# Appointment shards: users' appointments live in separate SQLite files
+# chosen by a consistent hash of the user id. Users and shard placements
+# stay in the primary database.
+PRIMARY_SHARD = 'primary'
+SHARD_KEYS = [f'shard_{i}' for i in range(int(os.environ.get('APPOINTMENT_SHARD_COUNT', 4)))]
+
+# Shard files left over from a larger shard count stay attached as retired
+# shards, off the ring, so rebalance-shards can drain users from them
+RETIRED_SHARD_KEYS = sorted(
+    match.group(1)
+    for match in (re.fullmatch(r'appointments_(shard_\d+)\.db', name) for name in os.listdir(basedir))
+    if match and match.group(1) not in SHARD_KEYS
+)
+app.config['SQLALCHEMY_BINDS'] = {
+    key: 'sqlite:///' + os.path.join(basedir, f'appointments_{key}.db')
+    for key in SHARD_KEYS + RETIRED_SHARD_KEYS
+}
+
+shard_ring = ConsistentHashRing(SHARD_KEYS)
+_current_shard = ContextVar('current_shard', default=None)
+
+class ShardedSession(Session):
+    """Session that sends appointment statements to the active shard"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and _is_sharded(mapper, clause):
+            shard = _current_shard.get()
+            if shard is None:
+                raise RuntimeError('Appointment query issued outside of a shard context')
+            return shard_engine(shard)
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+class ShardMovedError(Exception):
+    """Raised when an appointment write targets a shard the user is leaving"""
+
+def _is_sharded(mapper, clause):
+    tables = []
+    if mapper is not None:
+        tables.append(inspect(mapper).local_table)
+    if clause is not None:
+        tables.extend(find_tables(clause, include_crud=True))
+    return any(getattr(table, 'info', {}).get('sharded') for table in tables)
+
+db = SQLAlchemy(app, session_options={'class_': ShardedSession})
+
+def shard_engine(shard):
+    """Return the engine for a shard key"""
+    return db.engine if shard == PRIMARY_SHARD else db.engines[shard]
+
+@contextmanager
+def use_shard(shard):
+    """Route appointment queries in this block to the given shard"""
+    token = _current_shard.set(shard)
+    try:
+        yield
+    finally:
+        _current_shard.reset(token)
 
 # JWT Authentication decorator
 def token_required(f):
@@ -61,7 +129,19 @@ def token_required(f):
         except jwt.InvalidTokenError:
             return jsonify({'error': 'Invalid token'}), 401
         
-        return f(current_user, *args, **kwargs)
+        # Route the user's appointment queries to their shard
+        placement = pin_shard(current_user.id)
+        with use_shard(placement.shard):
+            try:
+                response = f(current_user, *args, **kwargs)
+            except ShardMovedError:
+                db.session.rollback()
+                response = None
+        
+        # Handlers may swallow the fence error in their own rollback path
+        if response is None or db.session.info.pop('shard_write_rejected', False):
+            return jsonify({'error': 'Appointments are being migrated, please retry shortly'}), 503
+        return response
     
     return decorated
 
@@ -102,9 +182,6 @@ class User(db.Model):
     last_login = db.Column(db.DateTime)
     is_active = db.Column(db.Boolean, default=True)
     
-    # Relationship
-    appointments = db.relationship('Appointment', backref='user', lazy=True, cascade="all, delete-orphan")
-    
     def set_password(self, password):
         """Hash and set password"""
         self.password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
@@ -113,6 +190,11 @@ class User(db.Model):
         """Check password against hash"""
         return bcrypt.checkpw(password.encode('utf-8'), self.password_hash.encode('utf-8'))
     
+    def appointment_count(self):
+        """Count the user's appointments on their shard"""
+        with use_shard(resolve_shard(self.id)):
+            return Appointment.query.filter_by(user_id=self.id).count()
+    
     def to_dict(self):
         """Convert user to dictionary (excluding sensitive data)"""
         return {
@@ -124,12 +206,52 @@ class User(db.Model):
             'createdAt': self.created_at.isoformat() if self.created_at else None,
             'lastLogin': self.last_login.isoformat() if self.last_login else None,
             'isActive': self.is_active,
-            'appointmentCount': len(self.appointments)
+            'appointmentCount': self.appointment_count()
         }
 
-# Appointment Model
-class Appointment(db.Model):
+# Shard placement Model
+class ShardPlacement(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    shard = db.Column(db.String(32), nullable=False)
+    migrating = db.Column(db.Boolean, default=False)  # appointment writes are rejected while True
+
+# Appointment id sequence Model
+class AppointmentSequence(db.Model):
+    """Single-row counter handing out appointment ids unique across all shards"""
     id = db.Column(db.Integer, primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+# Appointment ids are reserved from the primary database in blocks so that
+# appointment writes on the shards rarely touch it
+APPOINTMENT_ID_BLOCK_SIZE = 1000
+_id_block_lock = threading.Lock()
+_id_block = {'next': 1, 'last': 0}
+
+def next_appointment_id():
+    """Return an appointment id unique across all shards"""
+    with _id_block_lock:
+        if _id_block['next'] > _id_block['last']:
+            sequence = AppointmentSequence.__table__
+            # Short transaction of its own, so the primary write lock is never held across a shard flush
+            with db.engine.begin() as conn:
+                conn.execute(
+                    sequence.update()
+                    .where(sequence.c.id == 1)
+                    .values(value=sequence.c.value + APPOINTMENT_ID_BLOCK_SIZE)
+                )
+                last_id = conn.execute(select(sequence.c.value).where(sequence.c.id == 1)).scalar_one()
+            _id_block['next'] = last_id - APPOINTMENT_ID_BLOCK_SIZE + 1
+            _id_block['last'] = last_id
+        
+        appointment_id = _id_block['next']
+        _id_block['next'] += 1
+        return appointment_id
+
+# Appointment Model (stored on the owning user's shard)
+class Appointment(db.Model):
+    __table_args__ = {'info': {'sharded': True}}
+    
+    id = db.Column(db.Integer, primary_key=True, default=next_appointment_id)
     title = db.Column(db.String(100), nullable=False)
     description = db.Column(db.String(500))
     date = db.Column(db.String(20), nullable=False)  # YYYY-MM-DD
@@ -140,8 +262,8 @@ class Appointment(db.Model):
     status = db.Column(db.String(20), default='scheduled')  # scheduled, cancelled, completed
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
-    # Foreign key to user
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    # Owning user; no foreign key since the user table lives in the primary database
+    user_id = db.Column(db.Integer, nullable=False, index=True)
 
     def to_dict(self):
         return {
@@ -158,9 +280,202 @@ class Appointment(db.Model):
             'userId': self.user_id
         }
 
+@event.listens_for(ShardedSession, 'after_flush')
+def fence_appointment_writes(session, flush_context):
+    """Reject appointment writes for users that are moving or have moved.
+    
+    This runs after the flush, while the session holds the shard's write lock.
+    migrate_user_shard takes the same lock before copying, so a write either
+    commits before the copy starts or sees the new placement here.
+    """
+    user_ids = {
+        obj.user_id for obj in chain(session.new, session.dirty, session.deleted)
+        if isinstance(obj, Appointment)
+    }
+    if not user_ids:
+        return
+    
+    shard = _current_shard.get()
+    placements = ShardPlacement.__table__
+    rows = session.execute(
+        select(placements.c.shard, placements.c.migrating).where(placements.c.user_id.in_(user_ids))
+    ).all()
+    if any(row.migrating or row.shard != shard for row in rows):
+        session.info['shard_write_rejected'] = True
+        raise ShardMovedError('Appointments are being migrated to another shard')
+
+def _initial_shard(user_id):
+    # Users with appointments from before sharding stay on the primary database until rebalanced
+    with use_shard(PRIMARY_SHARD):
+        if Appointment.query.filter_by(user_id=user_id).first():
+            return PRIMARY_SHARD
+    return shard_ring.shard_for(user_id)
+
+def resolve_shard(user_id):
+    """Return the shard holding a user's appointments without pinning it"""
+    placement = ShardPlacement.query.get(user_id)
+    return placement.shard if placement else _initial_shard(user_id)
+
+def pin_shard(user_id):
+    """Return the user's shard placement, recording it on first use.
+    
+    Pinning keeps a user on the same shard when the ring changes; moves only
+    happen through the rebalance-shards command.
+    """
+    placement = ShardPlacement.query.get(user_id)
+    if placement:
+        return placement
+    
+    try:
+        placement = ShardPlacement(user_id=user_id, shard=_initial_shard(user_id), migrating=False)
+        db.session.add(placement)
+        db.session.commit()
+        return placement
+    except IntegrityError:
+        # Another request pinned the user first
+        db.session.rollback()
+        return ShardPlacement.query.get(user_id)
+
+def set_migrating(user_ids, migrating):
+    """Flag or unflag users as migrating in a single commit.
+    
+    Users without a placement yet are pinned in the same commit.
+    """
+    while True:
+        pinned = {
+            user_id for (user_id,) in
+            db.session.query(ShardPlacement.user_id).filter(ShardPlacement.user_id.in_(user_ids))
+        }
+        db.session.add_all(
+            ShardPlacement(user_id=user_id, shard=_initial_shard(user_id), migrating=migrating)
+            for user_id in user_ids if user_id not in pinned
+        )
+        ShardPlacement.query.filter(ShardPlacement.user_id.in_(pinned)).update(
+            {'migrating': migrating}, synchronize_session=False
+        )
+        try:
+            db.session.commit()
+            return
+        except IntegrityError:
+            # A request pinned one of the users first; retry with its placement
+            db.session.rollback()
+
+def migrate_user_shard(user_id, target):
+    """Move a user's appointments to another shard while the app keeps serving.
+    
+    The source shard's write lock is held from the copy until the source rows
+    are deleted, so writes that get past fence_appointment_writes land before
+    the copy. Reads keep using the source shard until the placement is
+    switched over. Callers flag the user with set_migrating first so their
+    writes are rejected instead of queueing on that lock.
+    Returns the number of appointments moved.
+    """
+    placement = pin_shard(user_id)
+    source = placement.shard
+    if source == target:
+        return 0
+    
+    table = Appointment.__table__
+    user_rows = table.c.user_id == user_id
+    with shard_engine(source).begin() as source_conn:
+        # A no-op update takes the source shard's write lock before reading
+        source_conn.execute(update(table).where(user_rows).values(user_id=table.c.user_id))
+        rows = source_conn.execute(select(table).where(user_rows)).mappings().all()
+        
+        with shard_engine(target).begin() as target_conn:
+            # Clear leftovers from an earlier interrupted run
+            target_conn.execute(delete(table).where(user_rows))
+            if rows:
+                target_conn.execute(insert(table), [dict(row) for row in rows])
+        
+        if source == PRIMARY_SHARD:
+            # The placement lives in the same file as the source rows, so switch
+            # it on the connection that already holds that file's write lock
+            placements = ShardPlacement.__table__
+            source_conn.execute(
+                update(placements).where(placements.c.user_id == user_id).values(shard=target)
+            )
+        else:
+            placement.shard = target
+            db.session.commit()
+        source_conn.execute(delete(table).where(user_rows))
+    
+    db.session.expire(placement)
+    return len(rows)
+
+@app.cli.command('rebalance-shards')
+@click.option('--dry-run', is_flag=True, help='Only list the users that would move.')
+@click.option('--batch-size', default=100, show_default=True,
+              help='Users locked and moved together.')
+@click.option('--grace', default=2.0, show_default=True,
+              help='Seconds to wait for in-flight writes after locking a batch.')
+def rebalance_shards(dry_run, batch_size, grace):
+    """Move users whose shard differs from their place on the hash ring."""
+    moves = []
+    for (user_id,) in db.session.query(User.id).order_by(User.id).all():
+        source = resolve_shard(user_id)
+        target = shard_ring.shard_for(user_id)
+        if source != target:
+            moves.append((user_id, source, target))
+    
+    if dry_run:
+        for user_id, source, target in moves:
+            click.echo(f'User {user_id}: {source} -> {target}')
+        click.echo(f'{len(moves)} users to move')
+        return
+    
+    moved = failed = 0
+    for start in range(0, len(moves), batch_size):
+        batch = moves[start:start + batch_size]
+        user_ids = [user_id for user_id, _, _ in batch]
+        set_migrating(user_ids, True)
+        try:
+            # Let requests that started before the lock finish their writes
+            time.sleep(grace)
+            for user_id, source, target in batch:
+                try:
+                    count = migrate_user_shard(user_id, target)
+                except Exception as e:
+                    # Leave the user on the source shard and carry on with the rest
+                    db.session.rollback()
+                    click.echo(f'User {user_id}: failed to move from {source} to {target}: {e}', err=True)
+                    failed += 1
+                    continue
+                click.echo(f'User {user_id}: moved {count} appointments from {source} to {target}')
+                moved += 1
+        finally:
+            db.session.rollback()
+            set_migrating(user_ids, False)
+    
+    click.echo(f'{moved} users moved, {failed} failed')
+    if failed:
+        raise SystemExit(1)
+
 # Initialize database
 with app.app_context():
     db.create_all()
+    for key in SHARD_KEYS + RETIRED_SHARD_KEYS:
+        Appointment.__table__.create(shard_engine(key), checkfirst=True)
+    
+    # Refuse to start if users live on a shard whose file is gone
+    missing_shards = {
+        shard for (shard,) in db.session.query(ShardPlacement.shard).distinct()
+    } - set(SHARD_KEYS + RETIRED_SHARD_KEYS + [PRIMARY_SHARD])
+    if missing_shards:
+        raise RuntimeError(f'Users are placed on unconfigured shards: {", ".join(sorted(missing_shards))}')
+    
+    # Start the id sequence above every existing appointment id
+    if not AppointmentSequence.query.get(1):
+        max_id = 0
+        for shard in [PRIMARY_SHARD] + SHARD_KEYS + RETIRED_SHARD_KEYS:
+            with use_shard(shard):
+                max_id = max(max_id, db.session.query(db.func.max(Appointment.id)).scalar() or 0)
+        try:
+            db.session.add(AppointmentSequence(id=1, value=max_id))
+            db.session.commit()
+        except IntegrityError:
+            # Another worker starting at the same time created it first
+            db.session.rollback()
     
     # Create a default test user if none exists
     if not User.query.first():
@@ -0,0 +1,31 @@
+import hashlib
+from bisect import bisect
+
+
+class ConsistentHashRing:
+    """Map user ids onto shard keys using a consistent hash ring.
+
+    Each shard owns several virtual nodes so users spread evenly, and adding
+    a shard only moves roughly 1/N of the users to it.
+    """
+
+    def __init__(self, shard_keys, vnodes=64):
+        if not shard_keys:
+            raise ValueError('At least one shard is required')
+
+        self.shard_keys = list(shard_keys)
+        self._ring = sorted(
+            (self._hash(f'{key}#{vnode}'), key)
+            for key in self.shard_keys
+            for vnode in range(vnodes)
+        )
+        self._points = [point for point, _ in self._ring]
+
+    @staticmethod
+    def _hash(value):
+        return int(hashlib.md5(str(value).encode('utf-8')).hexdigest()[:16], 16)
+
+    def shard_for(self, user_id):
+        """Return the shard key that owns the given user id"""
+        index = bisect(self._points, self._hash(user_id)) % len(self._ring)
+        return self._ring[index][1]
@@ -0,0 +1,57 @@
+import os
+import sys
+import tempfile
+import uuid
+
+import pytest
+
+# app.py sets up its databases at import time, so point it at a scratch
+# directory before the first import
+DATA_DIR = tempfile.mkdtemp(prefix='appointments-')
+os.environ['APPOINTMENTS_DATA_DIR'] = DATA_DIR
+os.environ['APPOINTMENT_SHARD_COUNT'] = '2'
+# A shard file left over from a larger shard count, attached as a retired shard
+open(os.path.join(DATA_DIR, 'appointments_shard_2.db'), 'w').close()
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as server  # noqa: E402
+
+
+@pytest.fixture
+def client():
+    return server.app.test_client()
+
+
+@pytest.fixture
+def make_user(client):
+    """Register a fresh user and return their id and auth headers"""
+    def make():
+        name = uuid.uuid4().hex[:12]
+        response = client.post('/api/auth/register', json={
+            'email': f'{name}@example.com',
+            'username': name,
+            'password': 'password123'
+        })
+        assert response.status_code == 201
+        data = response.get_json()
+        return data['user']['id'], {'Authorization': f'Bearer {data["accessToken"]}'}
+    return make
+
+
+@pytest.fixture
+def new_appointment():
+    """Build appointment payloads with distinct time slots"""
+    counter = iter(range(1, 10000))
+    def build(**overrides):
+        n = next(counter)
+        payload = {
+            'title': f'Appointment {n}',
+            'date': f'2026-{n % 12 + 1:02d}-{n % 28 + 1:02d}',
+            'time': f'{n % 24:02d}:{n % 60:02d}',
+            'customerName': 'Customer',
+            'customerEmail': 'customer@example.com'
+        }
+        payload.update(overrides)
+        return payload
+    return build
@@ -0,0 +1,284 @@
+import threading
+import time
+
+import app as server
+
+
+def shard_of(user_id):
+    with server.app.app_context():
+        return server.resolve_shard(user_id)
+
+
+def appointment_ids_on(shard, user_id):
+    table = server.Appointment.__table__
+    with server.app.app_context():
+        with server.shard_engine(shard).connect() as conn:
+            rows = conn.execute(server.select(table.c.id).where(table.c.user_id == user_id))
+            return sorted(row.id for row in rows)
+
+
+def rebalance(*args):
+    return server.app.test_cli_runner().invoke(args=['rebalance-shards', '--grace', '0', *args])
+
+
+def test_rebalance_moves_user_off_primary_database(client, make_user):
+    user_id, headers = make_user()
+
+    # Appointments written before sharding sit in the primary database
+    table = server.Appointment.__table__
+    with server.app.app_context():
+        legacy_ids = [server.next_appointment_id() for _ in range(2)]
+        with server.shard_engine(server.PRIMARY_SHARD).begin() as conn:
+            conn.execute(table.insert(), [
+                {'id': appointment_id, 'title': 'Legacy', 'date': '2025-01-01', 'time': f'0{n}:00',
+                 'duration': 60, 'customer_name': 'Customer', 'customer_email': 'customer@example.com',
+                 'status': 'scheduled', 'user_id': user_id}
+                for n, appointment_id in enumerate(legacy_ids)
+            ])
+
+    assert client.get('/api/appointments', headers=headers).get_json()['total'] == 2
+    assert shard_of(user_id) == server.PRIMARY_SHARD
+
+    result = rebalance()
+    assert result.exit_code == 0, result.output
+
+    target = server.shard_ring.shard_for(user_id)
+    assert shard_of(user_id) == target
+    assert appointment_ids_on(server.PRIMARY_SHARD, user_id) == []
+    assert appointment_ids_on(target, user_id) == sorted(legacy_ids)
+
+    listed = client.get('/api/appointments', headers=headers).get_json()['appointments']
+    assert sorted(appointment['id'] for appointment in listed) == sorted(legacy_ids)
+
+
+def test_rebalance_reports_failed_users_and_continues(monkeypatch, client, make_user, new_appointment):
+    user_ids = []
+    for _ in range(2):
+        user_id, headers = make_user()
+        assert client.post('/api/appointments', headers=headers, json=new_appointment()).status_code == 201
+        # Park each user off their ring shard so rebalance has to move them
+        with server.app.app_context():
+            server.migrate_user_shard(user_id, server.PRIMARY_SHARD)
+        user_ids.append(user_id)
+
+    broken_user, working_user = user_ids
+    migrate_user_shard = server.migrate_user_shard
+
+    def flaky_migrate(user_id, target):
+        if user_id == broken_user:
+            raise RuntimeError('disk full')
+        return migrate_user_shard(user_id, target)
+
+    monkeypatch.setattr(server, 'migrate_user_shard', flaky_migrate)
+    result = rebalance('--batch-size', '1')
+
+    assert result.exit_code == 1
+    assert f'User {broken_user}: failed to move' in result.output
+    assert 'disk full' in result.output
+    assert f'User {working_user}: moved 1 appointments' in result.output
+    assert '1 failed' in result.output
+    assert shard_of(broken_user) == server.PRIMARY_SHARD
+    assert shard_of(working_user) == server.shard_ring.shard_for(working_user)
+    with server.app.app_context():
+        assert server.ShardPlacement.query.filter_by(migrating=True).count() == 0
+
+
+def test_set_migrating_pins_new_users_in_one_commit(make_user):
+    user_ids = [make_user()[0] for _ in range(3)]
+    commits = []
+
+    with server.app.app_context():
+        server.pin_shard(user_ids[0])
+        server.event.listen(server.db.session(), 'after_commit', commits.append)
+        server.set_migrating(user_ids, True)
+
+        assert len(commits) == 1
+        placements = server.ShardPlacement.query.filter(server.ShardPlacement.user_id.in_(user_ids)).all()
+        assert len(placements) == 3
+        assert all(placement.migrating for placement in placements)
+
+        server.set_migrating(user_ids, False)
+
+
+def all_shards():
+    return [server.PRIMARY_SHARD] + server.SHARD_KEYS + server.RETIRED_SHARD_KEYS
+
+
+def users_on_distinct_shards(make_user):
+    """Register users until each ring shard has one"""
+    users = {}
+    while len(users) < len(server.SHARD_KEYS):
+        user_id, headers = make_user()
+        users.setdefault(server.shard_ring.shard_for(user_id), (user_id, headers))
+    return users
+
+
+def test_appointment_routes_use_pinned_shard(client, make_user, new_appointment):
+    users = users_on_distinct_shards(make_user)
+    (shard, (user_id, headers)), (other_shard, (other_id, other_headers)) = list(users.items())[:2]
+
+    ids = []
+    for _ in range(4):
+        response = client.post('/api/appointments', headers=headers, json=new_appointment())
+        assert response.status_code == 201
+        ids.append(response.get_json()['id'])
+    assert shard_of(user_id) == shard
+
+    listing = client.get('/api/appointments', headers=headers).get_json()
+    assert sorted(appointment['id'] for appointment in listing['appointments']) == sorted(ids)
+    assert client.get('/api/appointments/stats', headers=headers).get_json()['scheduled'] == 4
+
+    assert client.put(f'/api/appointments/{ids[0]}', headers=headers,
+                      json={'title': 'Renamed'}).get_json()['title'] == 'Renamed'
+    assert client.post(f'/api/appointments/{ids[1]}/cancel', headers=headers).get_json()['status'] == 'cancelled'
+    assert client.post(f'/api/appointments/{ids[2]}/complete', headers=headers).get_json()['status'] == 'completed'
+    assert client.post('/api/appointments/bulk', headers=headers,
+                       json={'appointmentIds': [ids[0]], 'action': 'cancel'}).status_code == 200
+    assert client.delete(f'/api/appointments/{ids[3]}', headers=headers).status_code == 200
+
+    stats = client.get('/api/appointments/stats', headers=headers).get_json()
+    assert (stats['total'], stats['cancelled'], stats['completed']) == (3, 2, 1)
+    assert client.get('/api/auth/user', headers=headers).get_json()['appointmentCount'] == 3
+
+    # Every row lives on the pinned shard and nowhere else
+    assert appointment_ids_on(shard, user_id) == sorted(ids[:3])
+    for other in all_shards():
+        if other != shard:
+            assert appointment_ids_on(other, user_id) == []
+
+    # Another user's shard never sees these appointments
+    assert shard_of(other_id) == other_shard
+    assert client.get('/api/appointments', headers=other_headers).get_json()['total'] == 0
+    assert client.put(f'/api/appointments/{ids[0]}', headers=other_headers, json={'title': 'x'}).status_code == 404
+    assert client.post('/api/appointments/bulk', headers=other_headers,
+                       json={'appointmentIds': ids, 'action': 'delete'}).status_code == 404
+
+
+def test_appointment_ids_are_unique_across_shards_and_moves(client, make_user, new_appointment):
+    users = users_on_distinct_shards(make_user)
+
+    ids_by_user = {}
+    for user_id, headers in users.values():
+        ids_by_user[user_id] = [
+            client.post('/api/appointments', headers=headers, json=new_appointment()).get_json()['id']
+            for _ in range(3)
+        ]
+    all_ids = [appointment_id for ids in ids_by_user.values() for appointment_id in ids]
+    assert len(set(all_ids)) == len(all_ids)
+
+    # Move one user onto another user's shard; their ids travel unchanged
+    (_, (moved_id, moved_headers)), (target, _) = list(users.items())[:2]
+    with server.app.app_context():
+        assert server.migrate_user_shard(moved_id, target) == 3
+    assert shard_of(moved_id) == target
+    listing = client.get('/api/appointments', headers=moved_headers).get_json()['appointments']
+    assert sorted(appointment['id'] for appointment in listing) == sorted(ids_by_user[moved_id])
+
+    new_id = client.post('/api/appointments', headers=moved_headers, json=new_appointment()).get_json()['id']
+    assert new_id not in all_ids
+    shard_ids = appointment_ids_on(target, moved_id)
+    assert len(set(shard_ids)) == len(shard_ids) == 4
+
+
+def test_writes_are_rejected_while_user_is_migrating(client, make_user, new_appointment):
+    user_id, headers = make_user()
+    appointment_id = client.post('/api/appointments', headers=headers, json=new_appointment()).get_json()['id']
+
+    with server.app.app_context():
+        server.set_migrating([user_id], True)
+    try:
+        assert client.post('/api/appointments', headers=headers, json=new_appointment()).status_code == 503
+        assert client.put(f'/api/appointments/{appointment_id}', headers=headers,
+                          json={'title': 'Renamed'}).status_code == 503
+        assert client.post(f'/api/appointments/{appointment_id}/cancel', headers=headers).status_code == 503
+        assert client.post(f'/api/appointments/{appointment_id}/complete', headers=headers).status_code == 503
+        assert client.post('/api/appointments/bulk', headers=headers,
+                           json={'appointmentIds': [appointment_id], 'action': 'delete'}).status_code == 503
+        assert client.delete(f'/api/appointments/{appointment_id}', headers=headers).status_code == 503
+
+        # Reads keep working
+        listing = client.get('/api/appointments', headers=headers)
+        assert listing.status_code == 200
+        assert listing.get_json()['appointments'][0]['status'] == 'scheduled'
+        assert client.get('/api/appointments/stats', headers=headers).status_code == 200
+    finally:
+        with server.app.app_context():
+            server.set_migrating([user_id], False)
+
+    assert appointment_ids_on(shard_of(user_id), user_id) == [appointment_id]
+    assert client.post('/api/appointments', headers=headers, json=new_appointment()).status_code == 201
+
+
+def test_write_aimed_at_old_shard_is_rejected_after_move(make_user):
+    user_id, _ = make_user()
+    with server.app.app_context():
+        source = server.pin_shard(user_id).shard
+        target = next(shard for shard in server.SHARD_KEYS if shard != source)
+        server.migrate_user_shard(user_id, target)
+
+    with server.app.app_context(), server.use_shard(source):
+        server.db.session.add(server.Appointment(
+            title='Stale', date='2026-01-01', time='10:00',
+            customer_name='Customer', customer_email='customer@example.com', user_id=user_id
+        ))
+        try:
+            server.db.session.commit()
+            raise AssertionError('write to the old shard was committed')
+        except server.ShardMovedError:
+            server.db.session.rollback()
+
+    assert appointment_ids_on(source, user_id) == []
+
+
+def test_in_flight_write_is_copied_by_migration(make_user):
+    user_id, _ = make_user()
+    with server.app.app_context():
+        source = server.pin_shard(user_id).shard
+    target = next(shard for shard in server.SHARD_KEYS if shard != source)
+
+    def migrate():
+        with server.app.app_context():
+            server.migrate_user_shard(user_id, target)
+
+    # The writer has flushed, so it holds the source shard's write lock
+    with server.app.app_context(), server.use_shard(source):
+        appointment = server.Appointment(
+            title='In flight', date='2026-01-01', time='10:00',
+            customer_name='Customer', customer_email='customer@example.com', user_id=user_id
+        )
+        server.db.session.add(appointment)
+        server.db.session.flush()
+        migration = threading.Thread(target=migrate)
+        migration.start()
+        time.sleep(0.5)
+        server.db.session.commit()
+        appointment_id = appointment.id
+    migration.join()
+
+    assert shard_of(user_id) == target
+    assert appointment_ids_on(target, user_id) == [appointment_id]
+    assert appointment_ids_on(source, user_id) == []
+
+
+def test_rebalance_drains_retired_shard(client, make_user, new_appointment):
+    assert server.RETIRED_SHARD_KEYS == ['shard_2']
+    assert 'shard_2' not in server.shard_ring.shard_keys
+
+    user_id, headers = make_user()
+    ids = [client.post('/api/appointments', headers=headers, json=new_appointment()).get_json()['id']
+           for _ in range(2)]
+    with server.app.app_context():
+        server.migrate_user_shard(user_id, 'shard_2')
+
+    # Users on a retired shard keep working until they are drained
+    assert shard_of(user_id) == 'shard_2'
+    assert client.get('/api/appointments', headers=headers).get_json()['total'] == 2
+
+    result = rebalance()
+    assert result.exit_code == 0, result.output
+    assert f'User {user_id}: moved 2 appointments from shard_2' in result.output
+
+    target = server.shard_ring.shard_for(user_id)
+    assert shard_of(user_id) == target
+    assert appointment_ids_on('shard_2', user_id) == []
+    assert appointment_ids_on(target, user_id) == sorted(ids)